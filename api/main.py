@@ -7,20 +7,24 @@ Provides webhook call for Plex-Meta-Manager, to create DizqueTV channels
 # pylint: disable=too-many-locals
 # pylint: disable=too-many-statements
 
+import asyncio
+import json
 import sys
+import threading
+import time
 from concurrent.futures.process import ProcessPoolExecutor
-from pprint import pformat
 from typing import Optional
 
-from dizqueTV import API
-from fastapi import FastAPI, Response, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from plexapi import server
 from pydantic import BaseModel
 
+import pmmdtv_cache
 import pmmdtv_config
 import pmmdtv_discord
 import pmmdtv_logger
+import pmmdtv_scheduler
 
 # create the API
 APP = FastAPI()
@@ -29,6 +33,12 @@ APP = FastAPI()
 # igmored collections
 ignored_collections = []
 
+# channel numbers are picked and used in two calls, so only one channel is created at a time
+create_channel_lock = threading.Lock()
+
+# seconds between checks for job progress, when streaming events
+EVENT_POLL_INTERVAL = 0.5
+
 # allow calls from anywhere
 APP.add_middleware(
     CORSMiddleware,
@@ -101,11 +111,23 @@ async def startup_event():
         logger.error("No PLEX Token is set")
         sys.exit(1)
 
+    # start the workers that process collections in the background
+    APP.state.scheduler = pmmdtv_scheduler.JobScheduler(
+        handlers={pmmdtv_scheduler.UPDATE: run_job,
+                  pmmdtv_scheduler.DELETE: run_delete_jobs},
+        workers=config['dizquetv'].get('workers', pmmdtv_scheduler.DEFAULT_WORKERS),
+        batch_kinds=(pmmdtv_scheduler.DELETE,))
+    APP.state.scheduler.start()
+
+    # import, connect and load caches off the critical path
+    pmmdtv_cache.start_warm_up(config, stats=APP.state.scheduler.stats)
+
 @APP.on_event("shutdown")
 async def on_shutdown():
     """
     APP termination code
     """
+    APP.state.scheduler.stop()
     APP.state.executor.shutdown()
 
 
@@ -117,10 +139,21 @@ def hook_start(start_time: StartRun):
     # reset the list of ignored collections
     ignored_collections = []
     # Validate the configuration
-    _ = pmmdtv_config.get_config(validate=True)
+    config = pmmdtv_config.get_config(validate=True)
+    # refresh the channel index and filler lists before the collections arrive
+    pmmdtv_cache.start_warm_up(config, stats=APP.state.scheduler.stats)
     return Response(status_code=200)
 
 
+@APP.get("/ready")
+def ready(response: Response):
+    """ Readiness check, reports when the startup warm-up is complete """
+    status = pmmdtv_cache.warm_up_status()
+    if not status['ready']:
+        response.status_code = 503
+    return status
+
+
 @APP.post("/end", status_code=200)
 def hook_end(end_time: EndRun):
     """ Webhook for when a PMM run ends """
@@ -140,10 +173,10 @@ def hook_end(end_time: EndRun):
 
 
 @APP.post("/collection", status_code=202)
-def hook_update(collection: Collection, background_tasks: BackgroundTasks):
+def hook_update(collection: Collection):
     """The actual webhook, /collection, which gets all collection updates"""
     logger = pmmdtv_logger.get_logger()
-    logger.debug("Collection Requested: %s", pformat(collection))
+    logger.debug("Collection Requested: %s", pmmdtv_logger.Pretty(collection))
 
     # get the collection config and see if we should ignore this one
     channel_config = pmmdtv_config.get_collection_config(col_section=collection.library_name,
@@ -155,60 +188,150 @@ def hook_update(collection: Collection, background_tasks: BackgroundTasks):
         ignored_collections.append(full_name)
         logger.info("Ignoring collection: %s, because the 'ignore' flag was set", full_name)
     else:
-        # Process the collection in the background
-        background_tasks.add_task(process_collection, collection)
+        # Process the collection in the background, cheapest channels first
+        job = APP.state.scheduler.submit(key=channel_config['channel_name'],
+                                         payload=collection,
+                                         priority=channel_config['priority'])
+        return JSONResponse(status_code=202, content={"job_id": job.job_id})
 
     # send back an ACCEPTED response, regardless of if it is ignored
     return Response(status_code=202)
 
-@APP.post("/delete", status_code=200)
+@APP.post("/delete", status_code=202)
 def hook_delete(collection: DeleteCollection):
     """ Webhook for when a PMM collection is deleted """
     logger = pmmdtv_logger.get_logger()
-    logger.info("Collection deleted: %s", pformat(collection))
-
-    config = pmmdtv_config.get_config()
+    logger.info("Collection deleted: %s", pmmdtv_logger.Pretty(collection))
 
     # make sure a collection name was provided
     if collection.message is None:
         logger.error("Null collection name was received")
-        return
+        return Response(status_code=202)
     # make sure a library was provided
     if collection.library_name is None:
         logger.error("Null library name was received")
-        return
+        return Response(status_code=202)
 
     # get the collection config and see if we should ignore this one
     channel_config = pmmdtv_config.get_collection_config(col_section=collection.library_name,
                                                          col_name=collection.message)
-    channel_name = collection.library_name + " - " + collection.message
-
-    # get the channel number, will return 0 if no channel exists
-    channel = dtv_get_channel_number(config=config, name=channel_name)
-    if channel == 0:
-        # channel not found
-        logger.info("Ignoring deletion of channel: %s, because it was not found in dizquetv",
-                    channel_name)
-        return Response(status_code=200)
+    channel_name = channel_config['channel_name']
 
     # check if the collection or library is marked to be ignored
     if channel_config['ignore']:
-
         logger.info("Ignoring deletion of channel: %s, because the 'ignore' flag was set",
                     channel_name)
-        return Response(status_code=200)
-
-    # handle collection deletion
-    logger.debug("Deleting channel (name: %s, number: %s)", channel_name, channel)
-    dtv_delete_channel(config=config, number=channel)
-    pmmdtv_discord.send_discord(config=config,
-                                message="Channel Deleted",
-                                channel_name=channel_name,
-                                channel_number=channel)
-    return Response(status_code=200)
+    else:
+        # Delete the channel in the background, after any pending work on it
+        job = APP.state.scheduler.submit(key=channel_name,
+                                         payload=collection,
+                                         kind=pmmdtv_scheduler.DELETE,
+                                         priority=channel_config['priority'],
+                                         cost=0)
+        return JSONResponse(status_code=202, content={"job_id": job.job_id})
+
+    return Response(status_code=202)
+
 
-def process_collection(collection: Collection):
-    """ background tasks to process the collection """
+async def job_events(job_id: int = None):
+    """ server-sent events for changes to one, or all, jobs """
+    versions = {}
+    while True:
+        if job_id is None:
+            jobs = APP.state.scheduler.jobs()
+        else:
+            jobs = [APP.state.scheduler.get_job(job_id)]
+        for job in jobs:
+            if job is None:
+                return
+            if versions.get(job.job_id) != job.version:
+                status = job.to_dict()
+                versions[job.job_id] = status['version']
+                yield f"event: job\nid: {status['id']}\ndata: {json.dumps(status)}\n\n"
+        if job_id is not None and jobs[0].state in pmmdtv_scheduler.FINISHED_STATES:
+            return
+        await asyncio.sleep(EVENT_POLL_INTERVAL)
+
+
+@APP.get("/jobs")
+def get_jobs(state: Optional[str] = None):
+    """ Lists the queued, running and recently finished jobs """
+    return [job.to_dict() for job in APP.state.scheduler.jobs()
+            if state is None or job.state == state]
+
+
+@APP.get("/jobs/events")
+def stream_jobs():
+    """ Streams the progress of all jobs, as server-sent events """
+    return StreamingResponse(job_events(), media_type="text/event-stream")
+
+
+@APP.get("/jobs/{job_id}")
+def get_job(job_id: int):
+    """ Gets the status of a single job """
+    job = APP.state.scheduler.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+
+@APP.get("/jobs/{job_id}/events")
+def stream_job(job_id: int):
+    """ Streams the progress of a single job, as server-sent events """
+    if APP.state.scheduler.get_job(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return StreamingResponse(job_events(job_id), media_type="text/event-stream")
+
+def run_job(job: pmmdtv_scheduler.Job):
+    """ scheduler handler, returns the number of programs synced """
+    return process_collection(collection=job.payload, job=job)
+
+def run_delete_jobs(jobs: list):
+    """
+    scheduler handler, deletes the channels of a batch of deleted collections,
+    returns the errors of the deletions that failed, by job id
+    """
+    logger = pmmdtv_logger.get_logger()
+    config = pmmdtv_config.get_config()
+
+    # one scan of the channels is shared by the whole batch, and always taken
+    # fresh, as a stale channel number would delete the wrong channel
+    started = time.time()
+    started_monotonic = time.monotonic()
+    channels = pmmdtv_cache.refresh_channels(config=config)
+    duration = time.monotonic() - started_monotonic
+    for job in jobs:
+        job.add_span("find channels", started=started, duration=duration)
+    logger.debug("Deleting %d channel(s)", len(jobs))
+
+    # each deletion is independent, one failing does not stop the rest
+    errors = {}
+    for job in jobs:
+        channel_name = job.key
+        channel = channels.get(channel_name, 0)
+        if channel == 0:
+            # channel not found
+            logger.info("Ignoring deletion of channel: %s, because it was not found in dizquetv",
+                        channel_name)
+            continue
+
+        logger.debug("Deleting channel (name: %s, number: %s)", channel_name, channel)
+        try:
+            with job.span("delete channel"):
+                dtv_delete_channel(config=config, number=channel)
+            with job.span("discord"):
+                pmmdtv_discord.send_discord(config=config,
+                                            message="Channel Deleted",
+                                            channel_name=channel_name,
+                                            channel_number=channel)
+        except Exception as error:  # pylint: disable=broad-except
+            logger.exception("Deletion of channel %s failed", channel_name)
+            errors[job.job_id] = str(error)
+
+    return errors
+
+def process_collection(collection: Collection, job: pmmdtv_scheduler.Job):
+    """ background tasks to process the collection, returns the number of programs """
     logger = pmmdtv_logger.get_logger()
     logger.debug("Processing %s", collection.collection)
 
@@ -220,26 +343,29 @@ def process_collection(collection: Collection):
     # make sure a collection name was provided
     if collection.collection is None:
         logger.error("Null collection name was received")
-        return
+        return None
 
     col_name = collection.collection
     col_section = collection.library_name
 
-    channel_config = pmmdtv_config.get_collection_config(col_section=col_section,
-                                                         col_name=col_name)
-    logger.debug("Collection Config: %s", pformat(channel_config))
+    with job.span("config"):
+        channel_config = pmmdtv_config.get_collection_config(col_section=col_section,
+                                                             col_name=col_name)
+    logger.debug("Collection Config: %s", pmmdtv_logger.Pretty(channel_config))
 
     channel_name = channel_config['channel_name']
     logger.info("Channel name: %s", channel_name)
 
     # get the channel number, will return 0 if no channel exists
-    channel = dtv_get_channel_number(config=config, name=channel_name)
+    with job.span("find channel"):
+        channel = dtv_get_channel_number(config=config, name=channel_name)
     logger.info("Channel number: %d", channel)
 
     # if the channel does not exist
     if channel == 0:
         logger.debug("Creating channel (name: %s, number: %s)", channel_name, channel)
-        channel = dtv_create_new_channel(config=config, name=channel_name)
+        with job.span("create channel"):
+            channel = dtv_create_new_channel(config=config, name=channel_name)
         operation = "Created"
 
     # get the channel group and set it
@@ -247,76 +373,67 @@ def process_collection(collection: Collection):
         logger.debug("Setting Channel Group (number: %s) to: %s",
                      channel,
                      channel_config['channel_group'])
-        dtv_set_channel_group(config=config,
-                              number=channel,
-                              channel_group=channel_config['channel_group'])
+        with job.span("channel group"):
+            dtv_set_channel_group(config=config,
+                                  number=channel,
+                                  channel_group=channel_config['channel_group'])
 
     # now remove the existing content and reset it
     logger.debug("Updating channel (name: %s, number: %s)", channel_name, channel)
     progs, minutes = dtv_update_programs(number=channel,
                                          collection=collection,
                                          config=config,
-                                         channel_config=channel_config)
+                                         channel_config=channel_config,
+                                         job=job)
 
     # update the poster
     if collection.poster_url:
         logger.debug("Updating channel %s with poster at %s", channel_name, collection.poster_url)
-        dtv_set_poster(config=config, number=channel, url=collection.poster_url)
+        with job.span("poster"):
+            dtv_set_poster(config=config, number=channel, url=collection.poster_url)
 
-    pmmdtv_discord.send_discord(config=config,
-                                message=f"Channel {operation}",
-                                channel_name=channel_name,
-                                channel_number=channel,
-                                channel_programs=progs,
-                                channel_playtime=minutes)
+    with job.span("discord"):
+        pmmdtv_discord.send_discord(config=config,
+                                    message=f"Channel {operation}",
+                                    channel_name=channel_name,
+                                    channel_number=channel,
+                                    channel_programs=progs,
+                                    channel_playtime=minutes)
 
-    return
+    return progs
 
 def get_plex_connection(config: dict):
     """ get a plex connection """
-    plex_url = config['plex']['url']
-    plex_token = config['plex']['token']
-    logger = pmmdtv_logger.get_logger()
-    logger.debug("Connecting to Plex at: %s", plex_url)
-    return server.PlexServer(plex_url, plex_token)
+    return pmmdtv_cache.get_plex_connection(config)
 
 
 def get_dtv_connection(config: dict):
     """ get a dizquetv connection """
-    diz_url = config['dizquetv']['url']
-    logger = pmmdtv_logger.get_logger()
-    logger.debug("Connecting to DizqueTV at: %s", diz_url)
-    return API(url=diz_url, verbose=False)
+    return pmmdtv_cache.get_dtv_connection(config)
 
 
 def dtv_get_channel_number(config: dict, name: str):
     """ get a channel number from a channel name, '0' indicates channel does not exist """
-    dtv_server = get_dtv_connection(config)
-    logger = pmmdtv_logger.get_logger()
-    for num in dtv_server.channel_numbers:
-        this_channel = dtv_server.get_channel(channel_number=num)
-        if this_channel.name == name:
-            logger.debug("Found channel, %d, for name %s", this_channel.number, this_channel.name)
-            return this_channel.number
-
-    return 0
+    return pmmdtv_cache.get_channel_number(config=config, name=name)
 
 
 def dtv_create_new_channel(config: dict, name: str):
     """ create a new channel by finding an unused channel number """
     dtv_server = get_dtv_connection(config)
     logger = pmmdtv_logger.get_logger()
-    # assume the lowest channel number is #1
-    lowest_available = 1
-    # if channels exist, get the lowest_available
-    if len(dtv_server.channel_numbers) > 0:
-        logger.debug("Looking for the lowest available channel number")
-        lowest_available = dtv_server.lowest_available_channel_number
-    logger.debug("Lowest available channel number is %d", lowest_available)
-    dtv_server.add_channel(programs=[],
-                           number=lowest_available,
-                           name=name,
-                           handle_errors=True)
+    with create_channel_lock:
+        # assume the lowest channel number is #1
+        lowest_available = 1
+        # if channels exist, get the lowest_available
+        if len(dtv_server.channel_numbers) > 0:
+            logger.debug("Looking for the lowest available channel number")
+            lowest_available = dtv_server.lowest_available_channel_number
+        logger.debug("Lowest available channel number is %d", lowest_available)
+        dtv_server.add_channel(programs=[],
+                               number=lowest_available,
+                               name=name,
+                               handle_errors=True)
+        pmmdtv_cache.add_channel(name=name, number=lowest_available)
 
     return lowest_available
 
@@ -324,7 +441,9 @@ def dtv_create_new_channel(config: dict, name: str):
 def dtv_delete_channel(config: dict, number: int):
     """ deletes a specified channel, by number """
     dtv_server = get_dtv_connection(config=config)
-    return dtv_server.delete_channel(channel_number=number)
+    result = dtv_server.delete_channel(channel_number=number)
+    pmmdtv_cache.remove_channel(number=number)
+    return result
 
 
 def dtv_set_poster(config: dict, number: int, url: str):
@@ -341,7 +460,8 @@ def dtv_set_channel_group(config: dict, number: int, channel_group: str):
                                      groupTitle=channel_group)
 
 
-def dtv_update_programs(config: dict, channel_config: dict, number: int, collection: Collection):
+def dtv_update_programs(config: dict, channel_config: dict, number: int, collection: Collection,
+                        job: pmmdtv_scheduler.Job):
     """ update the programming on a channel """
     logger = pmmdtv_logger.get_logger()
     logger.info("Channel %d: Updating programs", number)
@@ -349,7 +469,8 @@ def dtv_update_programs(config: dict, channel_config: dict, number: int, collect
     plex_server = get_plex_connection(config=config)
 
     # get the channel object
-    chan = dtv_server.get_channel(channel_number=number)
+    with job.span("get channel"):
+        chan = dtv_server.get_channel(channel_number=number)
 
     if chan == 0:
         logger.error("Could not find DizqueTV channel for number: %d", number)
@@ -359,17 +480,16 @@ def dtv_update_programs(config: dict, channel_config: dict, number: int, collect
 
     # find all shows and movies in the collection
     logger.debug("Channel %d: Gathering programs", number)
-    found_coll = plex_server.library.section(
-        collection.library_name).search(
-        title=collection.collection,
-        libtype='collection')
+    with job.span("gather programs"):
+        found_coll = plex_server.library.section(
+            collection.library_name).search(
+            title=collection.collection,
+            libtype='collection')
 
-    if found_coll and len(found_coll) == 1:
-        all_items.extend(found_coll[0].items())
+        if found_coll and len(found_coll) == 1:
+            all_items.extend(found_coll[0].items())
 
-    # build list of programs (movies and episodes)
-    total_minutes = 0
-    if all_items:
+        # build list of programs (movies and episodes)
         final_programs = []
         for item in all_items:
             if item.type in ('movie', 'episode'):
@@ -381,6 +501,8 @@ def dtv_update_programs(config: dict, channel_config: dict, number: int, collect
                             hasattr(episode, "duration") and episode.duration):
                         final_programs.append(episode)
 
+    total_minutes = 0
+    if all_items:
         # calculate the total duration of the programs
         for prog in final_programs:
             if (hasattr(prog, "duration") and prog.duration):
@@ -388,6 +510,7 @@ def dtv_update_programs(config: dict, channel_config: dict, number: int, collect
 
         channel_programs = len(final_programs)
         channel_playtime = total_minutes
+        job.progress(uploaded=0, total=channel_programs)
 
         # make sure the channel will play for at least a number of days
         min_days = channel_config['minimum_days']
@@ -395,50 +518,55 @@ def dtv_update_programs(config: dict, channel_config: dict, number: int, collect
 
         # remove existing content
         logger.debug("Channel %d: Removing exiting programs", number)
-        chan.delete_all_programs()
+        with job.span("remove programs"):
+            chan.delete_all_programs()
         # add new content
         logger.debug("Channel %d: Adding new programs", number)
-        # add items in chunks of 100 to allow the event loop some time
-        for i in range(0, len(final_programs), 100):
-            # taking the slice pulls up to, but not including the end number
-            logger.debug("Channel %d: Adding programs, %d-%d (total: %d)",
-                         number,
-                         i+1,
-                         i+100,
-                         len(final_programs))
-            chan.add_programs(programs=final_programs[i:i+100],
-                              plex_server=plex_server)
+        with job.span("add programs"):
+            # add items in chunks of 100 to allow the event loop some time
+            for i in range(0, len(final_programs), 100):
+                # taking the slice pulls up to, but not including the end number
+                logger.debug("Channel %d: Adding programs, %d-%d (total: %d)",
+                             number,
+                             i+1,
+                             i+100,
+                             len(final_programs))
+                chan.add_programs(programs=final_programs[i:i+100],
+                                  plex_server=plex_server)
+                job.progress(uploaded=min(i+100, channel_programs), total=channel_programs)
 
         # add fillers if requested
-        chan.delete_all_filler_lists()
-        fillers = channel_config['fillers']
-
-        for a_filler in fillers:
-            logger.debug("Channel %d: Adding Filler List: %s", number, a_filler)
-            filler_list = dtv_server.get_filler_list_by_name(a_filler)
-            if filler_list:
-                chan.add_filler_list(filler_list=filler_list)
-            else:
-                logger.debug("Channel %d: Unable to find Filler List: %s", number, a_filler)
+        with job.span("fillers"):
+            chan.delete_all_filler_lists()
+            fillers = channel_config['fillers']
+
+            for a_filler in fillers:
+                logger.debug("Channel %d: Adding Filler List: %s", number, a_filler)
+                filler_list = pmmdtv_cache.get_filler_list(config=config, name=a_filler)
+                if filler_list:
+                    chan.add_filler_list(filler_list=filler_list)
+                else:
+                    logger.debug("Channel %d: Unable to find Filler List: %s", number, a_filler)
 
         logger.debug("Channel %d: Setting replicate count to %d", number, times_to_repeat)
 
-        # sort things randomly
-        if channel_config['random']:
-            logger.debug("Channel %d: Sorting programs randomly", number)
-            chan.cyclical_shuffle()
-        else:
-            logger.debug("Channel %d: Skipping the randomize of programs per config", number)
+        with job.span("schedule"):
+            # sort things randomly
+            if channel_config['random']:
+                logger.debug("Channel %d: Sorting programs randomly", number)
+                chan.cyclical_shuffle()
+            else:
+                logger.debug("Channel %d: Skipping the randomize of programs per config", number)
 
-        chan.replicate(how_many_times=times_to_repeat)
+            chan.replicate(how_many_times=times_to_repeat)
 
-        # set padding if requested
-        pad = channel_config['pad']
-        if pad and pad != 0:
-            logger.debug("Channel %d: Setting time padding to %d minutes", number, pad)
-            chan.pad_times(start_every_x_minutes=pad)
-        else:
-            logger.debug("Channel %d: Padding is disabled", number)
+            # set padding if requested
+            pad = channel_config['pad']
+            if pad and pad != 0:
+                logger.debug("Channel %d: Setting time padding to %d minutes", number, pad)
+                chan.pad_times(start_every_x_minutes=pad)
+            else:
+                logger.debug("Channel %d: Padding is disabled", number)
 
         return channel_programs, channel_playtime
 
@@ -0,0 +1,306 @@
+"""
+Caches Plex/DizqueTV connections, the channel index and filler lists, and
+pre-warms them in the background so the first webhook is not served cold
+"""
+
+# pylint: disable=import-error
+# pylint: disable=global-statement
+# pylint: disable=invalid-name
+
+import importlib
+import threading
+import time
+
+import pmmdtv_logger
+
+# modules that are slow to import, loaded by the warm-up instead of at startup
+HEAVY_MODULES = ("plexapi.server", "dizqueTV", "discord_webhook", "human_readable")
+
+# guards the caches below, never held while importing or talking to a server
+_lock = threading.RLock()
+# connections, keyed by the settings used to create them
+_plex_connections = {}
+_dtv_connections = {}
+# channel name -> channel number
+_channel_index = {}
+# changes made to the index, as (generation, name, number), number is None for
+# a removal, these are replayed over a scan that was running when they were made
+_channel_changes = []
+_channel_generation = 0
+_channel_scans = 0
+# filler list name -> filler list
+_filler_lists = {}
+_filler_lists_loaded = False
+
+# seconds before retrying a failed warm-up, doubled after each failure
+WARM_UP_RETRY = 5
+WARM_UP_RETRY_MAX = 300
+
+# warm-up state, reported by the readiness endpoint, with its own lock so
+# that readiness never waits on the caches
+_warm_up_lock = threading.Lock()
+_warm_up = {
+    "ready": False,
+    "running": False,
+    "started": None,
+    "duration": None,
+    "attempts": 0,
+    "retry_in": None,
+    "errors": [],
+}
+# the (config, stats) to warm up with, the latest is used by a warm-up that is retrying
+_warm_up_request = (None, None)
+
+
+def get_plex_connection(config: dict):
+    """ get a (cached) plex connection """
+    plex_url = config['plex']['url']
+    plex_token = config['plex']['token']
+    with _lock:
+        connection = _plex_connections.get((plex_url, plex_token))
+    if connection is None:
+        # connect without the lock, a slow or unreachable server must not stall the caches
+        server = importlib.import_module("plexapi.server")
+        logger = pmmdtv_logger.get_logger()
+        logger.debug("Connecting to Plex at: %s", plex_url)
+        connection = server.PlexServer(plex_url, plex_token)
+        with _lock:
+            # another thread may have connected in the meantime, keep the first
+            connection = _plex_connections.setdefault((plex_url, plex_token), connection)
+    return connection
+
+
+def get_dtv_connection(config: dict):
+    """ get a (cached) dizquetv connection """
+    diz_url = config['dizquetv']['url']
+    with _lock:
+        connection = _dtv_connections.get(diz_url)
+    if connection is None:
+        # connect without the lock, a slow or unreachable server must not stall the caches
+        dizquetv = importlib.import_module("dizqueTV")
+        logger = pmmdtv_logger.get_logger()
+        logger.debug("Connecting to DizqueTV at: %s", diz_url)
+        connection = dizquetv.API(url=diz_url, verbose=False)
+        with _lock:
+            # another thread may have connected in the meantime, keep the first
+            connection = _dtv_connections.setdefault(diz_url, connection)
+    return connection
+
+
+def refresh_channels(config: dict, stats=None):
+    """
+    Rebuild the channel index with a full scan of DizqueTV channels, and
+    return a copy of it. If provided, the collection size of each channel is
+    seeded into 'stats'
+    """
+    global _channel_scans
+    logger = pmmdtv_logger.get_logger()
+    with _lock:
+        _channel_scans += 1
+        generation = _channel_generation
+    try:
+        dtv_server = get_dtv_connection(config)
+        index = {}
+        for num in dtv_server.channel_numbers:
+            this_channel = dtv_server.get_channel(channel_number=num)
+            if not this_channel:
+                continue
+            index[this_channel.name] = this_channel.number
+            if stats is not None:
+                items = collection_size(this_channel)
+                if items:
+                    stats.seed(this_channel.name, items)
+        with _lock:
+            # channels created or deleted while scanning may be missing from the scan
+            for change_generation, name, number in _channel_changes:
+                if change_generation <= generation:
+                    continue
+                if number is None:
+                    index.pop(name, None)
+                else:
+                    index[name] = number
+            _channel_index.clear()
+            _channel_index.update(index)
+            index = dict(_channel_index)
+    finally:
+        with _lock:
+            _channel_scans -= 1
+            if not _channel_scans:
+                _channel_changes.clear()
+    logger.debug("Indexed %d DizqueTV channels", len(index))
+    return index
+
+
+def collection_size(channel):
+    """
+    The number of programs a channel was built from. A channel's program list
+    has been replicated and padded, so only distinct, non-padding programs are
+    counted, to match the item counts recorded after a sync. None if unknown
+    """
+    keys = set()
+    for program in getattr(channel, "programs", None) or []:
+        if getattr(program, "isOffline", False):
+            continue
+        key = getattr(program, "ratingKey", None) or getattr(program, "key", None)
+        if key is None:
+            return None
+        keys.add(key)
+    return len(keys)
+
+
+def get_channel_number(config: dict, name: str):
+    """ get a channel number from a channel name, '0' indicates channel does not exist """
+    logger = pmmdtv_logger.get_logger()
+    with _lock:
+        number = _channel_index.get(name, 0)
+
+    # trust, but verify, the index, the channel may have changed within DizqueTV
+    if number:
+        this_channel = get_dtv_connection(config).get_channel(channel_number=number)
+        if this_channel and this_channel.name == name:
+            logger.debug("Found channel, %d, for name %s", number, name)
+            return number
+        logger.debug("Channel index is stale for name %s", name)
+
+    # a miss is always confirmed with a scan, the channel may have been created
+    # within DizqueTV, and a wrong miss would create a duplicate channel
+    number = refresh_channels(config).get(name, 0)
+    if number:
+        logger.debug("Found channel, %d, for name %s", number, name)
+    return number
+
+
+def _record_channel_change(name: str, number: int = None):
+    """ apply a change to the index, caller must hold the lock """
+    global _channel_generation
+    _channel_generation += 1
+    if number is None:
+        _channel_index.pop(name, None)
+    else:
+        _channel_index[name] = number
+    if _channel_scans:
+        _channel_changes.append((_channel_generation, name, number))
+
+
+def add_channel(name: str, number: int):
+    """ record a newly created channel in the index """
+    with _lock:
+        _record_channel_change(name, number)
+
+
+def remove_channel(number: int):
+    """ remove a deleted channel from the index """
+    with _lock:
+        for name in [name for name, num in _channel_index.items() if num == number]:
+            _record_channel_change(name)
+
+
+def refresh_filler_lists(config: dict):
+    """ take a snapshot of the DizqueTV filler lists """
+    global _filler_lists_loaded
+    logger = pmmdtv_logger.get_logger()
+    dtv_server = get_dtv_connection(config)
+    snapshot = {filler_list.name: filler_list for filler_list in dtv_server.filler_lists}
+    with _lock:
+        _filler_lists.clear()
+        _filler_lists.update(snapshot)
+        _filler_lists_loaded = True
+    logger.debug("Cached %d DizqueTV filler lists", len(snapshot))
+
+
+def get_filler_list(config: dict, name: str):
+    """ get a filler list by name, from the snapshot if possible """
+    with _lock:
+        filler_list = _filler_lists.get(name)
+    if filler_list:
+        return filler_list
+
+    # not in the snapshot, it may have been created since it was taken
+    filler_list = get_dtv_connection(config).get_filler_list_by_name(name)
+    if filler_list:
+        with _lock:
+            _filler_lists[name] = filler_list
+    return filler_list
+
+
+def _warm_up_attempt(config: dict, stats=None):
+    """ run each step of the warm-up, returns if the required steps succeeded """
+    logger = pmmdtv_logger.get_logger()
+    with _warm_up_lock:
+        _warm_up["attempts"] += 1
+        _warm_up["errors"] = []
+    # (name, function, arguments, required for readiness)
+    steps = [(f"import {module}", importlib.import_module, (module,), True)
+             for module in HEAVY_MODULES]
+    steps += [
+        ("plex connection", get_plex_connection, (config,), True),
+        ("dizquetv connection", get_dtv_connection, (config,), True),
+        ("channel index", refresh_channels, (config, stats), True),
+        # filler lists are looked up within DizqueTV if they were not cached
+        ("filler lists", refresh_filler_lists, (config,), False),
+    ]
+    ready = True
+    for step, func, args, required in steps:
+        try:
+            func(*args)
+        except Exception as error:  # pylint: disable=broad-except
+            logger.warning("Warm-up of %s failed: %s", step, error)
+            ready = ready and not required
+            with _warm_up_lock:
+                _warm_up["errors"].append(f"{step}: {error}")
+    return ready
+
+
+def warm_up(config: dict, stats=None):
+    """
+    import modules, connect to servers and load the caches, retrying with
+    backoff until Plex and DizqueTV can be reached
+    """
+    global _warm_up_request
+    logger = pmmdtv_logger.get_logger()
+    with _warm_up_lock:
+        # a newer configuration is picked up by a warm-up that is retrying
+        _warm_up_request = (config, stats)
+        if _warm_up["running"]:
+            logger.debug("Warm-up already in progress")
+            return
+        _warm_up["running"] = True
+        _warm_up["started"] = time.time()
+        _warm_up["attempts"] = 0
+    started = time.monotonic()
+
+    delay = WARM_UP_RETRY
+    while True:
+        with _warm_up_lock:
+            config, stats = _warm_up_request
+        ready = _warm_up_attempt(config, stats)
+        duration = time.monotonic() - started
+        with _warm_up_lock:
+            _warm_up["ready"] = ready
+            _warm_up["duration"] = duration
+            _warm_up["retry_in"] = None if ready else delay
+            if ready:
+                _warm_up["running"] = False
+        if ready:
+            logger.info("Warm-up complete in %.1f seconds", duration)
+            return
+        logger.error("Warm-up failed after %.1f seconds, not ready, retrying in %d seconds",
+                     duration, delay)
+        time.sleep(delay)
+        delay = min(delay * 2, WARM_UP_RETRY_MAX)
+
+
+def start_warm_up(config: dict, stats=None):
+    """ warm up in a background thread """
+    thread = threading.Thread(target=warm_up,
+                              args=(config, stats),
+                              name="pmmdtv-warm-up",
+                              daemon=True)
+    thread.start()
+    return thread
+
+
+def warm_up_status():
+    """ the state of the warm-up, for the readiness endpoint """
+    with _warm_up_lock:
+        return dict(_warm_up, errors=list(_warm_up["errors"]))
@@ -22,6 +22,7 @@ config_schema_dizquetv = Schema({
     "url": str,
     Optional("debug"): bool,
     Optional("ignore"): bool,
+    Optional("workers"): int,
     Optional("discord"): {
         Optional("url"): str,
         Optional("username"): str,
@@ -38,6 +39,7 @@ config_schema_defaults = Schema({
     Optional("random"): bool,
     Optional("dizquetv_start"): int,
     Optional("ignore"): bool,
+    Optional("priority"): int,
 })
 
 # configuration for channels section
@@ -49,6 +51,7 @@ config_schema_channel = Schema({
     Optional("channel_name"): str,
     Optional("random"): bool,
     Optional("ignore"): bool,
+    Optional("priority"): int,
 })
 
 def get_config(validate: bool = False):
@@ -200,5 +203,8 @@ def set_collection_defaults(channel_name: str, settings: dict):
     if 'random' not in settings:
         settings['random'] = True
 
+    if 'priority' not in settings:
+        settings['priority'] = 0
+
     if 'channel_name' not in settings:
         settings['channel_name'] = channel_name
@@ -6,9 +6,6 @@ Provides webhook call for Plex-Meta-Manager, to create DizqueTV channels
 
 import datetime
 
-from discord_webhook import DiscordWebhook, DiscordEmbed
-import human_readable
-
 import pmmdtv_logger
 
 # pylint: disable=R0913
@@ -19,6 +16,10 @@ def send_discord(config: dict,
                  channel_programs: int = 0,
                  channel_playtime: int = 0):
     """ send a notification that the channel is processed """
+    # imported here, these are slow to load and not needed until the first channel is done
+    from discord_webhook import DiscordWebhook, DiscordEmbed  # pylint: disable=import-outside-toplevel
+    import human_readable  # pylint: disable=import-outside-toplevel
+
     logger = pmmdtv_logger.get_logger()
     if 'discord' not in config['dizquetv'] or 'url' not in config['dizquetv']['discord']:
         logger.debug("Discord webhook not set, skipping notification")
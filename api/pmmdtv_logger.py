@@ -5,6 +5,7 @@ Provides webhook call for Plex-Meta-Manager, to create DizqueTV channels
 # pylint: disable=import-error
 
 import logging
+from pprint import pformat
 
 LOGGING_CONFIG = {
     "version": 1,
@@ -41,3 +42,14 @@ def get_logger():
     # get the LOGGER, we wll use the uvicorn LOGGER to make format consistent
     logger = logging.getLogger("default")
     return logger
+
+
+class Pretty:  # pylint: disable=too-few-public-methods
+    """
+    Pretty prints an object for logging, only if the message is emitted
+    """
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return pformat(self.obj)
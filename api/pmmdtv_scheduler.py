@@ -0,0 +1,324 @@
+"""
+Schedules the background synchronization of collections to DizqueTV channels
+"""
+
+# pylint: disable=import-error
+
+import contextlib
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+import pmmdtv_logger
+
+# estimated cost (seconds) of a channel that has never been seen
+DEFAULT_COST = 30.0
+# initial estimate of seconds per program, refined as channels are synced
+DEFAULT_SECONDS_PER_ITEM = 0.05
+# weight given to the newest sample when refining seconds per program
+RATE_SMOOTHING = 0.2
+# seconds of estimated cost forgiven for every second a job has waited
+AGING_RATE = 1.0
+# seconds of estimated cost forgiven for every level of configured priority
+PRIORITY_WEIGHT = 60.0
+# worker threads, more than one so a large channel cannot hold up all others
+DEFAULT_WORKERS = 3
+
+# finished jobs kept for reporting
+MAX_FINISHED_JOBS = 200
+
+# kinds of job
+UPDATE = "update"
+DELETE = "delete"
+
+# states of a job
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+REPLACED = "replaced"
+FINISHED_STATES = (DONE, FAILED, REPLACED)
+
+_job_ids = itertools.count(1)
+
+
+class Job:  # pylint: disable=too-many-instance-attributes
+    """
+    A unit of background work for a single channel, traced as it runs
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(self, key: str, payload, kind: str = UPDATE,
+                 priority: int = 0, cost: float = DEFAULT_COST):
+        self.job_id = next(_job_ids)
+        self.kind = kind
+        self.key = key
+        self.payload = payload
+        self.priority = priority
+        self.cost = cost
+        self.queued_at = time.monotonic()
+        self.state = QUEUED
+        self.error = None
+        self.replaced_by = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.programs_total = 0
+        self.programs_uploaded = 0
+        self.spans = []
+        # incremented on every change, so watchers can tell when to report
+        self.version = 0
+        self._lock = threading.Lock()
+
+    def set_state(self, state: str, error: str = None):
+        """ move the job to a new state """
+        with self._lock:
+            self.state = state
+            self.error = error
+            if state == RUNNING:
+                self.started = time.time()
+            elif state in FINISHED_STATES:
+                self.finished = time.time()
+            self.version += 1
+
+    @contextlib.contextmanager
+    def span(self, stage: str):
+        """ time a stage of the job """
+        # the start is reported as wall-clock time, the duration is not affected by clock changes
+        started = time.time()
+        started_monotonic = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_span(stage, started=started,
+                          duration=time.monotonic() - started_monotonic)
+
+    def add_span(self, stage: str, started: float, duration: float):
+        """ record a stage of the job that was timed elsewhere, e.g. shared by a batch """
+        with self._lock:
+            self.spans.append({"stage": stage,
+                               "started": started,
+                               "duration": duration})
+            self.version += 1
+
+    def progress(self, uploaded: int, total: int):
+        """ record the number of programs uploaded so far """
+        with self._lock:
+            self.programs_uploaded = uploaded
+            self.programs_total = total
+            self.version += 1
+
+    def to_dict(self):
+        """ the job, as reported by the jobs API """
+        with self._lock:
+            stages = {}
+            for span in self.spans:
+                stages[span["stage"]] = stages.get(span["stage"], 0) + span["duration"]
+            return {
+                "id": self.job_id,
+                "kind": self.kind,
+                "channel": self.key,
+                "state": self.state,
+                "error": self.error,
+                "replaced_by": self.replaced_by,
+                "priority": self.priority,
+                "estimated_cost": self.cost,
+                "created": self.created,
+                "started": self.started,
+                "finished": self.finished,
+                "programs_total": self.programs_total,
+                "programs_uploaded": self.programs_uploaded,
+                "stages": stages,
+                "spans": list(self.spans),
+                "version": self.version,
+            }
+
+
+class ChannelStats:
+    """
+    Remembers item counts and sync durations per channel, to estimate job cost
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items = {}
+        self._durations = {}
+        self._seconds_per_item = DEFAULT_SECONDS_PER_ITEM
+
+    def record(self, key: str, items: int = None, duration: float = None):
+        """ record the item count and/or duration of a channel """
+        with self._lock:
+            if items is not None:
+                self._items[key] = items
+            if duration is not None:
+                self._durations[key] = duration
+            if items and duration is not None:
+                self._seconds_per_item += RATE_SMOOTHING * (
+                    duration / items - self._seconds_per_item)
+
+    def seed(self, key: str, items: int):
+        """ record an item count for a channel, unless it is already known """
+        with self._lock:
+            self._items.setdefault(key, items)
+
+    def estimate(self, key: str):
+        """ estimated seconds needed to sync a channel """
+        with self._lock:
+            if key in self._durations:
+                return self._durations[key]
+            if key in self._items:
+                return self._items[key] * self._seconds_per_item
+            return DEFAULT_COST
+
+
+class JobScheduler:  # pylint: disable=too-many-instance-attributes
+    """
+    Runs queued jobs on a pool of worker threads, cheapest (estimated) job first.
+
+    The score of a job is its estimated cost, reduced by its configured priority
+    and by the time it has been waiting, so that large jobs are not starved.
+    Only one job per channel is pending at a time, a newer submission replaces
+    the pending one, and jobs for a channel never run concurrently. So a
+    deletion replaces a pending update of the channel, and waits for a running
+    one to complete.
+
+    'handlers' maps each kind of job to the callable that runs it. Kinds listed
+    in 'batch_kinds' are run together, their handler is given every runnable
+    pending job of that kind at once, and returns a dict of job id to error
+    message for the jobs of the batch that failed.
+    """
+    def __init__(self, handlers: dict, workers: int = DEFAULT_WORKERS, batch_kinds: tuple = ()):
+        self._handlers = handlers
+        self._batch_kinds = batch_kinds
+        self._workers = max(1, workers)
+        self._pending = []
+        self._running = set()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._stopping = False
+        # every job, by id, in the order they were queued
+        self._jobs = OrderedDict()
+        self.stats = ChannelStats()
+
+    def start(self):
+        """ start the worker threads """
+        for i in range(self._workers):
+            thread = threading.Thread(target=self._work,
+                                      name=f"pmmdtv-worker-{i}",
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """ stop the worker threads once their current job is complete """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+    # pylint: disable=too-many-arguments
+    def submit(self, key: str, payload, kind: str = UPDATE,
+               priority: int = 0, cost: float = None):
+        """ queue a job for a channel, replacing any job still pending for it """
+        logger = pmmdtv_logger.get_logger()
+        if cost is None:
+            cost = self.stats.estimate(key)
+        job = Job(key=key, payload=payload, kind=kind, priority=priority, cost=cost)
+        with self._cond:
+            for pending in self._pending:
+                if pending.key == key:
+                    logger.debug("Replacing pending job for channel: %s", key)
+                    # keep waiting time already accrued by the replaced job
+                    job.queued_at = pending.queued_at
+                    self._pending.remove(pending)
+                    pending.replaced_by = job.job_id
+                    pending.set_state(REPLACED)
+                    break
+            self._pending.append(job)
+            self._jobs[job.job_id] = job
+            self._prune()
+            self._cond.notify()
+        logger.debug("Queued %s job %d for channel: %s (estimated %.1fs, priority %d)",
+                     kind, job.job_id, key, job.cost, priority)
+        return job
+
+    def pending(self):
+        """ number of jobs waiting to run """
+        with self._cond:
+            return len(self._pending)
+
+    def jobs(self):
+        """ all known jobs, oldest first """
+        with self._cond:
+            return list(self._jobs.values())
+
+    def get_job(self, job_id: int):
+        """ a job by id, None if it is unknown """
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def _prune(self):
+        """ forget the oldest finished jobs, caller must hold the lock """
+        finished = [job_id for job_id, job in self._jobs.items()
+                    if job.state in FINISHED_STATES]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+    @staticmethod
+    def _score(job: Job, now: float):
+        """ lower scores run first """
+        return job.cost - job.priority * PRIORITY_WEIGHT - (now - job.queued_at) * AGING_RATE
+
+    def _next_jobs(self):
+        """ wait for, and claim, the best runnable job(s); None when stopping """
+        with self._cond:
+            while True:
+                if self._stopping:
+                    return None
+                now = time.monotonic()
+                runnable = [job for job in self._pending if job.key not in self._running]
+                if runnable:
+                    job = min(runnable, key=lambda j: (self._score(j, now), j.job_id))
+                    jobs = [job]
+                    if job.kind in self._batch_kinds:
+                        jobs = [j for j in runnable if j.kind == job.kind]
+                    for claimed in jobs:
+                        self._pending.remove(claimed)
+                        self._running.add(claimed.key)
+                        claimed.set_state(RUNNING)
+                    return jobs
+                self._cond.wait()
+
+    def _work(self):
+        """ worker thread loop """
+        logger = pmmdtv_logger.get_logger()
+        while True:
+            jobs = self._next_jobs()
+            if jobs is None:
+                return
+            kind = jobs[0].kind
+            keys = ", ".join(job.key for job in jobs)
+            started = time.monotonic()
+            items = None
+            # job id -> error message, for the jobs that failed
+            errors = {}
+            try:
+                if kind in self._batch_kinds:
+                    errors = self._handlers[kind](jobs) or {}
+                else:
+                    items = self._handlers[kind](jobs[0])
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.exception("The %s of channel(s) %s failed", kind, keys)
+                errors = {job.job_id: str(exc) for job in jobs}
+            finally:
+                duration = time.monotonic() - started
+                with self._cond:
+                    for job in jobs:
+                        self._running.discard(job.key)
+                        if job.job_id in errors:
+                            job.set_state(FAILED, error=errors[job.job_id])
+                        else:
+                            job.set_state(DONE)
+                    self._prune()
+                    self._cond.notify_all()
+            if items is not None:
+                self.stats.record(jobs[0].key, items=items, duration=duration)
+            logger.debug("The %s of channel(s) %s finished in %.1fs", kind, keys, duration)